@@ -21,19 +21,57 @@ __version__ = "1.0.0"
 
 
 import argparse
+import atexit
 import csv
+import email.message
+import email.parser
+import email.utils
+import imaplib
 import logging
 import logging.handlers
+import mailbox as mailboxlib
+import multiprocessing
 import os
+import queue
+import re
 import shlex
+import socket
 import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from itertools import islice
+from operator import attrgetter
 from pprint import pformat
-from typing import Iterable, List, Optional
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, TypeVar
+
+from imap_upload.imap_utf7 import decode as imap_utf7_decode, encode as imap_utf7_encode
 
 logger = logging.getLogger(__name__)
 
+# old username, old password, old host, old port, old SSL, new username, new password, new host, new port, new SSL
+CSV_FIELDS_COUNT = 10
+FALSE_STRINGS = frozenset(("false", "0", "no"))
+DEFAULT_PORTS = {True: "993", False: "143"}
+# Seconds between checks for finished imapgrab processes
+REAP_INTERVAL = 0.1
+# Messages and bytes sent per MULTIAPPEND command, to bound memory used by a single command. A message larger than
+# MULTIAPPEND_BATCH_BYTES is sent alone.
+MULTIAPPEND_BATCH_SIZE = 50
+MULTIAPPEND_BATCH_BYTES = 16 * 1024 * 1024
+# Largest non-synchronizing literal allowed by LITERAL- (RFC 7888)
+LITERAL_MINUS_MAX_SIZE = 4096
+log_listener = None  # type: Optional[logging.handlers.QueueListener]
+
+T = TypeVar("T")
+
 
 class Mailbox:
+    __slots__ = ("type", "username", "password", "host", "port", "use_ssl", "safe_username")
+
     def __init__(self, type_: str, username: str, password: str, host: str, port: Optional[int] = None,
                  use_ssl: Optional[bool] = False):
         self.type = type_
@@ -42,29 +80,315 @@ class Mailbox:
         self.host = host
         self.port = port
         self.use_ssl = False if use_ssl is None else use_ssl
+        # Username usable as a backup directory name
+        self.safe_username = username.replace("@", "_at_")
+
+    def is_complete(self) -> bool:
+        """
+        Check whether the mailbox has all the information needed to connect to it.
+
+        :return: True if host, username and password are all set.
+        :rtype: bool
+        """
+        return bool(self.host and self.username and self.password)
 
     def __repr__(self):
-        return "Mailbox({username} " \
-               "on {server}:{port} " \
-               "SSL={use_ssl} " \
-               "type={type})".format(username=self.username, server=self.host, port=self.port, use_ssl=self.use_ssl,
-                                     type=self.type)
+        return f"Mailbox({self.username} on {self.host}:{self.port} SSL={self.use_ssl} type={self.type})"
 
     def __str__(self):
-        return "{username} on {server}:{port} ({type})".format(username=self.username, server=self.host, port=self.port,
-                                                               type=self.type)
+        return f"{self.username} on {self.host}:{self.port} ({self.type})"
 
 
 class Migration:
+    __slots__ = ("old", "new")
+
     def __init__(self, old_mailbox: Mailbox, new_mailbox: Mailbox):
         self.old = old_mailbox
         self.new = new_mailbox
 
     def __repr__(self):
-        return "{old} => {new}".format(old=self.old, new=self.new)
+        return f"{self.old} => {self.new}"
 
     def __str__(self):
-        return "{old} => {new}".format(old=self.old, new=self.new)
+        return f"{self.old} => {self.new}"
+
+
+class ImapBackend:
+    """
+    Persistent IMAP session to a mailbox, so that a single login serves all the folders of a migration.
+    """
+
+    # Folders known to exist, per (host, username), shared by all sessions to the same account
+    _folders_cache = {}  # type: Dict[Tuple[str, str], Set[str]]
+    _folders_cache_lock = threading.Lock()
+
+    _list_response_re = re.compile(rb'\((?P<flags>[^)]*)\) (?P<delimiter>NIL|"(?:[^"\\]|\\.)*") (?P<name>.*)')
+    _line_endings_re = re.compile(rb"\r\n|\r|\n")
+
+    def __init__(self, mailbox: Mailbox, retry: int = 3, timeout: int = 60):
+        self.mailbox = mailbox
+        self.retry = retry
+        self.timeout = timeout
+        self.imap = None  # type: Optional[imaplib.IMAP4]
+        self.capabilities = frozenset()  # type: Set[str]
+
+    def __enter__(self):
+        try:
+            self.login()
+        except BaseException:
+            # __exit__ is not called when __enter__ raises, don't leak the connection
+            self.logout()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.logout()
+
+    def login(self):
+        if self.imap:
+            return
+
+        imap_class = imaplib.IMAP4_SSL if self.mailbox.use_ssl else imaplib.IMAP4
+        self.imap = imap_class(self.mailbox.host, int(self.mailbox.port))
+        self.imap.socket().settimeout(self.timeout)
+        # Commands are written in several small parts, don't let them wait for the server's delayed ACKs
+        self.imap.socket().setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.imap.login(self.mailbox.username, self.mailbox.password)
+
+        # Capabilities announced before login may not be complete
+        _, data = self.imap.capability()
+        self.capabilities = frozenset(data[-1].decode(errors="replace").upper().split())
+
+    def logout(self):
+        if not self.imap:
+            return
+
+        try:
+            self.imap.logout()
+        except (imaplib.IMAP4.error, OSError):
+            pass
+        self.imap = None
+
+    @staticmethod
+    def quote_folder(folder: str) -> bytes:
+        """
+        Encode a folder name to a quoted IMAP UTF-7 string.
+
+        :param folder: Folder name.
+        :type folder: str
+        :return: Quoted and encoded folder name, suitable for IMAP commands.
+        :rtype: bytes
+        """
+        return b'"' + imap_utf7_encode(folder).replace(b"\\", b"\\\\").replace(b'"', b'\\"') + b'"'
+
+    @staticmethod
+    def internal_date(delivery_time: Optional[float]) -> Optional[str]:
+        """
+        Convert a delivery time to a quoted INTERNALDATE string, as sent in APPEND commands.
+
+        :param delivery_time: Delivery time, as seconds since epoch, or None.
+        :type delivery_time: Optional[float]
+        :return: Quoted date, or None to let the server decide when delivery time is unset or can't be represented.
+        :rtype: Optional[str]
+        """
+        if not delivery_time:
+            return None
+        try:
+            return imaplib.Time2Internaldate(delivery_time)
+        except (OverflowError, ValueError, OSError):
+            logger.warning("Ignoring out of range delivery time %s.", delivery_time)
+            return None
+
+    @staticmethod
+    def unquote_folder(folder: bytes) -> str:
+        """
+        Decode a folder name, as found in a LIST response.
+
+        :param folder: Folder name, possibly quoted, in IMAP UTF-7.
+        :type folder: bytes
+        :return: Decoded folder name.
+        :rtype: str
+        """
+        if folder.startswith(b'"') and folder.endswith(b'"'):
+            folder = folder[1:-1].replace(b'\\"', b'"').replace(b"\\\\", b"\\")
+        return imap_utf7_decode(folder)
+
+    def list(self) -> List[str]:
+        """
+        List all folders of the mailbox.
+
+        :return: Decoded folder names.
+        :rtype: List[str]
+        """
+        _, data = self._retrying(lambda: self.imap.list())
+
+        folders = []
+        for line in data:
+            # Folder names sent as literals come as a (line, literal) tuple
+            if isinstance(line, tuple):
+                line, literal = line
+            else:
+                literal = None
+
+            match = self._list_response_re.match(line or b"")
+            if match is None:
+                continue
+            folders.append(self.unquote_folder(match.group("name") if literal is None else literal))
+
+        return folders
+
+    def create(self, folder: str):
+        """
+        Create a folder, unless it is already known to exist.
+
+        :param folder: Folder name.
+        :type folder: str
+        :return: None
+        :rtype: None
+        """
+        key = (self.mailbox.host, self.mailbox.username)
+
+        with self._folders_cache_lock:
+            folders = self._folders_cache.get(key)
+        if folders is None:
+            folders = set(self.list())
+            with self._folders_cache_lock:
+                folders = self._folders_cache.setdefault(key, folders)
+
+        if folder in folders:
+            return
+
+        # Server answers NO when the folder was created in the meantime
+        self._retrying(lambda: self.imap.create(self.quote_folder(folder)))
+        with self._folders_cache_lock:
+            folders.add(folder)
+
+    @property
+    def supports_multiappend(self) -> bool:
+        self.login()
+        return "MULTIAPPEND" in self.capabilities
+
+    def _retrying(self, command: Callable[[], T]) -> T:
+        """
+        Run an IMAP command, reconnecting if the connection gets aborted.
+
+        :param command: Function sending the command and returning its response.
+        :type command: Callable[[], T]
+        :return: Response returned by command.
+        :rtype: T
+        """
+        retry = self.retry
+        while True:
+            try:
+                self.login()
+                return command()
+            except (imaplib.IMAP4.abort, OSError):
+                # Connection is unusable, close it rather than leaking its socket
+                if self.imap is not None:
+                    try:
+                        self.imap.shutdown()
+                    except OSError:
+                        pass
+                self.imap = None
+                if retry == 0:
+                    raise
+                retry -= 1
+                logger.warning("Connection to %s aborted, reconnecting.", self.mailbox)
+                time.sleep(5)
+
+    def append(self, folder: str, delivery_time: Optional[float], message: bytes) -> str:
+        """
+        Append a message to a folder, reconnecting if the connection gets aborted.
+
+        :param folder: Destination folder name.
+        :type folder: str
+        :param delivery_time: Delivery time of the message, as seconds since epoch, or None to let the server decide.
+        :type delivery_time: Optional[float]
+        :param message: Raw RFC 2822 message.
+        :type message: bytes
+        :return: IMAP response type ("OK" on success).
+        :rtype: str
+        """
+        date_time = self.internal_date(delivery_time)
+        return self._retrying(lambda: self.imap.append(self.quote_folder(folder), None, date_time, message)[0])
+
+    def multiappend(self, folder: str, messages: List[Tuple[Optional[float], bytes]]) -> str:
+        """
+        Append several messages to a folder in a single MULTIAPPEND command (RFC 3502).
+
+        The server appends either all the messages, or none of them. When it supports non-synchronizing literals
+        (LITERAL+ or LITERAL-, RFC 7888), messages are sent without waiting for a continuation request before each of
+        them, so that the whole command costs a single round-trip.
+
+        :param folder: Destination folder name.
+        :type folder: str
+        :param messages: (delivery time, raw RFC 2822 message) tuples, as taken by append.
+        :type messages: List[Tuple[Optional[float], bytes]]
+        :return: IMAP response type ("OK" on success).
+        :rtype: str
+        """
+        def _command():
+            literals = self._iter_literals(messages)
+            announce, literal = next(literals)
+            # imaplib only sends a single synchronizing literal per command, literals are written here instead. The
+            # command line is sent as if it had no literal, so that _command returns without waiting for the server.
+            tag = self.imap._command("APPEND", self.quote_folder(folder), announce)
+            while literal is not None:
+                if not announce.endswith(b"+}") and not self._wait_continuation(tag):
+                    # Server refused the command before getting all the messages
+                    break
+                self.imap.send(literal)
+                # Each literal is followed by the announce of the next message, on the same line
+                announce, literal = next(literals, (None, None))
+                self.imap.send((b" " + announce if announce else b"") + imaplib.CRLF)
+            typ, _ = self.imap._command_complete("APPEND", tag)
+            return typ
+
+        return self._retrying(_command)
+
+    def _iter_literals(self, messages: Iterable[Tuple[Optional[float], bytes]]) -> Iterator[Tuple[bytes, bytes]]:
+        """
+        Encode messages to APPEND literals, one at a time, so that a batch is not held twice in memory.
+
+        :param messages: (delivery time, raw RFC 2822 message) tuples.
+        :type messages: Iterable[Tuple[Optional[float], bytes]]
+        :return: Iterator over (announce, literal) tuples, the announce being the optional date and literal size.
+        :rtype: Iterator[Tuple[bytes, bytes]]
+        """
+        literal_plus = "LITERAL+" in self.capabilities
+        literal_minus = "LITERAL-" in self.capabilities
+
+        for delivery_time, message in messages:
+            literal = self._line_endings_re.sub(b"\r\n", message)
+            date_time = self.internal_date(delivery_time)
+            non_synchronizing = literal_plus or (literal_minus and len(literal) <= LITERAL_MINUS_MAX_SIZE)
+            size = (b"{%d+}" if non_synchronizing else b"{%d}") % len(literal)
+            yield (date_time.encode() + b" " if date_time else b"") + size, literal
+
+    def _wait_continuation(self, tag: bytes) -> bool:
+        """
+        Wait for the server to request the next literal of a command.
+
+        :param tag: Tag of the running command.
+        :type tag: bytes
+        :return: True on continuation request, False if the server completed the command instead (e.g. NO).
+        :rtype: bool
+        """
+        # Untagged responses may come first, _get_response returns None on continuation requests only
+        while self.imap._get_response():
+            if self.imap.tagged_commands[tag]:
+                return False
+        return True
+
+
+def _positive_int(value: str) -> int:
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+    return number
 
 
 def parse_args():
@@ -80,6 +404,10 @@ def parse_args():
     argparser.add_argument("-b", "--backup", action="store_true", help="Backup \"old\" mailboxes to files.")
     argparser.add_argument("-o", "--output", type=str, default="backups/", help="Path to store mailboxes backup files.")
     argparser.add_argument("-r", "--restore", action="store_true", help="Restore backup files to \"new\" mailboxes.")
+    argparser.add_argument("-j", "--jobs", type=_positive_int, default=4,
+                           help="Number of mailboxes to process in parallel.")
+    argparser.add_argument("--per-user-jobs", type=_positive_int, default=3,
+                           help="Number of IMAP sessions restoring folders in parallel to a single \"new\" mailbox.")
     argparser.add_argument("-v", "--verbosity", action="count", default=0)
     argparser.add_argument("mailboxes", type=str, nargs="+", help="List of mailboxes to migrate. Mailboxes must be "
                                                                   "identified by their \"old_username\" value from the "
@@ -94,6 +422,9 @@ def init_logger(verbosity: int) -> logging.Logger:
     """
     Setup logger instance.
 
+    Records are handed over to a background listener thread, so that writing to the log file and the terminal does
+    not block the migration.
+
     :param verbosity: Verbosity level (between 0 and 4).
     :type verbosity: int
     :return: None
@@ -114,154 +445,601 @@ def init_logger(verbosity: int) -> logging.Logger:
 
     fh = logging.handlers.RotatingFileHandler("imap_migrator.log", 'a', 500000, 3)
     fh.setFormatter(timed_formatter)
-    logger.addHandler(fh)
 
     ch = logging.StreamHandler()
     ch.setFormatter(no_timed_formatter)
-    logger.addHandler(ch)
+
+    global log_listener
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    log_listener = logging.handlers.QueueListener(log_queue, fh, ch)
+    log_listener.start()
+    # Flush pending records on exit
+    atexit.register(log_listener.stop)
 
     return logger
 
 
-def parse_mailboxes_csv(csv_path: str, mailboxes_filter: List[str]) -> Iterable[Migration]:
-    migrations = []
+def parse_mailboxes_csv(csv_path: str, mailboxes_filter: List[str]) -> Iterator[Migration]:
+    """
+    Read migrations from a CSV file, as rows are parsed.
+
+    The returned iterator can only be consumed once, it must be materialized to be handed to several actions.
+
+    :param csv_path: Path to the CSV file.
+    :type csv_path: str
+    :param mailboxes_filter: "old" usernames of the migrations to keep, or ["all"] to keep them all.
+    :type mailboxes_filter: List[str]
+    :return: Iterator over migrations.
+    :rtype: Iterator[Migration]
+    """
+    mailboxes_filter = frozenset(mailboxes_filter)
+    filter_all = mailboxes_filter == {"all"}
 
     try:
         csv_handle = open(csv_path, "r", newline="")
     except FileNotFoundError:
-        logger.critical("CSV file \"{}\" not found.".format(csv_path))
+        logger.critical("CSV file \"%s\" not found.", csv_path)
         exit(1)
     except PermissionError:
-        logger.critical("Access denied to CSV file \"{}\"".format(csv_path))
+        logger.critical("Access denied to CSV file \"%s\"", csv_path)
         exit(1)
 
     else:
         with csv_handle:
-            csv_reader = csv.DictReader(csv_handle, fieldnames=("old_username", "old_pass", "old_host", "old_port",
-                                                                "old_ssl", "new_username", "new_pass", "new_host",
-                                                                "new_port", "new_ssl"),
-                                        quotechar="\"", skipinitialspace=True)
+            csv_reader = csv.reader(csv_handle, quotechar="\"", skipinitialspace=True)
             for row in csv_reader:
-                # Translate use_ssl string to bool
-                row["old_ssl"] = False if row["old_ssl"] is not None and row["old_ssl"].lower() == "false" else True
-                row["new_ssl"] = False if row["new_ssl"] is not None and row["new_ssl"].lower() == "false" else True
-
-                # Default ports
-                if not row["old_port"]:
-                    if row["old_ssl"]:
-                        row["old_port"] = "993"
-                    else:
-                        row["old_port"] = "143"
-                if not row["new_port"]:
-                    if row["new_ssl"]:
-                        row["new_port"] = "993"
-                    else:
-                        row["new_port"] = "143"
-
-                old_mailbox = Mailbox("old", row["old_username"], row["old_pass"], row["old_host"], row["old_port"],
-                                      row["old_ssl"])
-                new_mailbox = Mailbox("new", row["new_username"], row["new_pass"], row["new_host"], row["new_port"],
-                                      row["new_ssl"])
-
-                if mailboxes_filter == ["all"] or old_mailbox.username in mailboxes_filter:
-                    migrations.append(Migration(old_mailbox=old_mailbox, new_mailbox=new_mailbox))
-
-    return migrations
-
-
-def list_mailboxes(migrations: Iterable[Migration], type_: str) -> Iterable[Mailbox]:
+                if not row:
+                    continue
+                # Missing trailing fields are empty
+                if len(row) < CSV_FIELDS_COUNT:
+                    row += [""] * (CSV_FIELDS_COUNT - len(row))
+
+                (old_username, old_pass, old_host, old_port, old_ssl,
+                 new_username, new_pass, new_host, new_port, new_ssl) = row[:CSV_FIELDS_COUNT]
+
+                if not filter_all and old_username not in mailboxes_filter:
+                    continue
+
+                # Translate use_ssl string to bool, SSL is used unless explicitly disabled
+                old_ssl = old_ssl.strip().lower() not in FALSE_STRINGS
+                new_ssl = new_ssl.strip().lower() not in FALSE_STRINGS
+
+                old_mailbox = Mailbox("old", old_username, old_pass, old_host, old_port or DEFAULT_PORTS[old_ssl],
+                                      old_ssl)
+                new_mailbox = Mailbox("new", new_username, new_pass, new_host, new_port or DEFAULT_PORTS[new_ssl],
+                                      new_ssl)
+
+                yield Migration(old_mailbox=old_mailbox, new_mailbox=new_mailbox)
+
+
+def _run_commands(commands: Iterable[Tuple[Mailbox, List[str]]],
+                  jobs: int) -> Iterator[Tuple[Mailbox, subprocess.CompletedProcess]]:
+    """
+    Run commands, keeping up to `jobs` of them running at once, and yield them as they complete.
+
+    Outputs are spooled to temporary files rather than pipes, so that a chatty child can't block while waiting for
+    its pipe to be read, and so that concurrent children don't interleave on the terminal.
+
+    :param commands: (mailbox, command line) tuples to run.
+    :type commands: Iterable[Tuple[Mailbox, List[str]]]
+    :param jobs: Maximum number of commands running at once.
+    :type jobs: int
+    :return: Iterator over (mailbox, completed process) tuples, in completion order.
+    :rtype: Iterator[Tuple[Mailbox, subprocess.CompletedProcess]]
+    """
+    in_flight = {}
+
+    def _reap():
+        # Only wait for our own children, others (e.g. multiprocessing helpers) are not ours to reap
+        while True:
+            finished_pid = next((pid for pid, (process, *_) in in_flight.items() if process.poll() is not None), None)
+            if finished_pid is not None:
+                break
+            time.sleep(REAP_INTERVAL)
+        process, mailbox, stdout, stderr = in_flight.pop(finished_pid)
+
+        outputs = []
+        for output in (stdout, stderr):
+            with output:
+                output.seek(0)
+                outputs.append(output.read().decode(errors="replace"))
+
+        return mailbox, subprocess.CompletedProcess(process.args, process.returncode, *outputs)
+
+    for mailbox, cmdl in commands:
+        if len(in_flight) >= jobs:
+            yield _reap()
+
+        stdout = tempfile.TemporaryFile()
+        stderr = tempfile.TemporaryFile()
+        process = subprocess.Popen(cmdl, stdout=stdout, stderr=stderr)
+        in_flight[process.pid] = (process, mailbox, stdout, stderr)
+
+    while in_flight:
+        yield _reap()
+
+
+def _log_command(cmdl: List[str], password: str):
+    """
+    Log a command line at DEBUG level, with its password argument hidden.
+
+    :param cmdl: Command line.
+    :type cmdl: List[str]
+    :param password: Password object present in the command line.
+    :type password: str
+    :return: None
+    :rtype: None
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(" ".join("******" if arg is password else shlex.quote(arg) for arg in cmdl))
+
+
+def _log_output(mailbox: Mailbox, completed: subprocess.CompletedProcess):
+    """
+    Log the captured output of a finished command.
+
+    :param mailbox: Mailbox the command operated on.
+    :type mailbox: Mailbox
+    :param completed: Completed process, as returned by _run_commands.
+    :type completed: subprocess.CompletedProcess
+    :return: None
+    :rtype: None
+    """
+    if completed.stdout:
+        logger.info("Output for mailbox %s:\n%s", mailbox.username, completed.stdout.rstrip())
+    if completed.stderr:
+        level = logging.ERROR if completed.returncode != 0 else logging.INFO
+        logger.log(level, "Errors for mailbox %s:\n%s", mailbox.username, completed.stderr.rstrip())
+
+
+def _command_failure(completed: subprocess.CompletedProcess) -> str:
+    """
+    Describe why a command failed, from its exit code and the last line it output.
+
+    :param completed: Completed process, as returned by _run_commands.
+    :type completed: subprocess.CompletedProcess
+    :return: Failure description.
+    :rtype: str
+    """
+    output_lines = (completed.stderr or completed.stdout).strip().splitlines()
+    if output_lines:
+        return f"exit code {completed.returncode}: {output_lines[-1]}"
+    return f"exit code {completed.returncode}"
+
+
+def _flush_log():
+    """
+    Wait for the log listener thread to write pending records.
+
+    :return: None
+    :rtype: None
+    """
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener.start()
+
+
+def _report_failures(description: str, failures: List[Tuple[object, str]]):
+    """
+    Log failed mailboxes, and write them to stderr when errors are not logged, so that they are visible whatever the
+    verbosity.
+
+    Child output is captured and only logged according to verbosity, so this keeps failures visible on a default
+    run.
+
+    :param description: Description of the failed action, e.g. "Backup failed".
+    :type description: str
+    :param failures: (mailbox or migration, failure description) tuples.
+    :type failures: List[Tuple[object, str]]
+    :return: None
+    :rtype: None
+    """
+    if not failures:
+        return
+
+    lines = [f"{description} for following mailboxes:"]
+    lines.extend(f"  {item}: {reason}" for item, reason in failures)
+    summary = "\n".join(lines)
+    logger.error(summary)
+
+    if not logger.isEnabledFor(logging.ERROR):
+        # The listener thread writes to stderr too, let it finish so that lines don't interleave
+        _flush_log()
+        sys.stderr.write(summary + "\n")
+
+
+def list_mailboxes(migrations: Iterable[Migration], attr_getter: Callable[[Migration], Mailbox],
+                   jobs: int) -> List[Mailbox]:
     success = []
-    mailboxes = (getattr(migration, type_) for migration in migrations)
+    failures = []
+    mailboxes = map(attr_getter, migrations)
+
+    def _commands():
+        for mailbox in mailboxes:
+            if not mailbox.is_complete():
+                logger.warning("Skipping incomplete mailbox %s", mailbox)
+                continue
 
-    for mailbox in mailboxes:
-        logger.info("Listing mailbox {}".format(mailbox.username))
-        cmdl = shlex.split("imapbackup/imapgrab.py -l "
-                           "-s {host} -u \"{username}\" -p \"{password}\"".format(host=mailbox.host,
-                                                                                  username=mailbox.username,
-                                                                                  password=mailbox.password))
-        logger.debug(cmdl[:-1] + ["******"])
+            logger.info("Listing mailbox %s", mailbox.username)
+            cmdl = ["imapbackup/imapgrab.py", "-l", "-s", mailbox.host, "-u", mailbox.username, "-p", mailbox.password]
+            _log_command(cmdl, mailbox.password)
 
-        return_code = subprocess.call(cmdl)
+            yield mailbox, cmdl
 
-        if return_code == 0:
+    for mailbox, completed in _run_commands(_commands(), jobs):
+        # Listing output is what the user asked for, print it as a whole
+        sys.stdout.write(completed.stdout)
+        if completed.stderr:
+            logger.error("Errors for mailbox %s:\n%s", mailbox.username, completed.stderr.rstrip())
+
+        if completed.returncode == 0:
             success.append(mailbox)
+        else:
+            failures.append((mailbox, _command_failure(completed)))
+
+    _report_failures("Listing failed", failures)
 
     return success
 
 
-def backup_mailboxes(migrations: Iterable[Migration], output_dir: str) -> List[Mailbox]:
+def backup_mailboxes(migrations: Iterable[Migration], output_dir: str, jobs: int) -> List[Mailbox]:
     success = []
+    failures = []
     os.makedirs(output_dir, exist_ok=True)
     mailboxes = (migration.old for migration in migrations)
 
-    for mailbox in mailboxes:
-        logger.info("Backing up mailbox {}".format(mailbox.username))
+    def _commands():
+        for mailbox in mailboxes:
+            if not mailbox.is_complete():
+                logger.warning("Skipping incomplete mailbox %s", mailbox)
+                continue
 
-        user_output_dir = os.path.abspath(os.path.join(output_dir, mailbox.username.replace("@", "_at_")))
-        try:
-            os.mkdir(user_output_dir)
-        except FileExistsError:
-            pass
+            logger.info("Backing up mailbox %s", mailbox.username)
 
-        use_ssl = "-S" if mailbox.use_ssl else ""
-        cmdl = shlex.split('imapbackup/imapgrab.py -v -d {ssl} -f "{output_dir}" -s "{host}" -u "{username}" '
-                           '-p "{password}" -m "_ALL_"'.format(ssl=use_ssl, output_dir=user_output_dir,
-                                                               host=mailbox.host, username=mailbox.username,
-                                                               password=mailbox.password))
-        cmdl_without_password = cmdl.copy()
-        cmdl_without_password[-3] = "******"
-        logger.debug(cmdl_without_password)
+            user_output_dir = os.path.abspath(os.path.join(output_dir, mailbox.safe_username))
+            os.makedirs(user_output_dir, exist_ok=True)
 
-        return_code = subprocess.call(cmdl)
+            use_ssl = ["-S"] if mailbox.use_ssl else []
+            cmdl = ["imapbackup/imapgrab.py", "-v", "-d", *use_ssl, "-f", user_output_dir, "-s", mailbox.host,
+                    "-u", mailbox.username, "-p", mailbox.password, "-m", "_ALL_"]
+            _log_command(cmdl, mailbox.password)
 
-        if return_code == 0:
+            yield mailbox, cmdl
+
+    for mailbox, completed in _run_commands(_commands(), jobs):
+        _log_output(mailbox, completed)
+
+        if completed.returncode == 0:
             success.append(mailbox)
+        else:
+            failures.append((mailbox, _command_failure(completed)))
 
-    return success
+    _report_failures("Backup failed", failures)
 
+    return success
 
-def restore_mailboxes(migrations: Iterable[Migration], backup_dir: str) -> List[Migration]:
-    success = []
 
-    for migration in migrations:
-        if not migration.new.username or not migration.new.host:
+def _get_delivery_time(from_line: str, headers: email.message.Message) -> Optional[float]:
+    """
+    Extract delivery time of a message from its From_ line, first "Received:" field or "Date:" field.
+
+    :param from_line: From_ line of the message, without its "From " prefix.
+    :type from_line: str
+    :param headers: Header fields of the message.
+    :type headers: email.message.Message
+    :return: Delivery time as seconds since epoch, or None if no field holds a valid time.
+    :rtype: Optional[float]
+    """
+    from_line = from_line.split(" ", 1)
+    from_time = None
+    if len(from_line) > 1:
+        # asctime format of the From_ line does not end with a timezone, parsedate_tz needs the weekday removed
+        from_time = re.sub(r" (sun|mon|tue|wed|thu|fri|sat) ", " ", f" {from_line[1].replace(',', ' ')} ",
+                           flags=re.IGNORECASE)
+        # Some From_ lines only hold a date
+        if ":" not in from_time:
+            from_time += " 00:00:00"
+    received = headers["received"]
+    candidates = (
+        from_time,
+        str(received).split(";", 1)[-1].strip() if received else None,
+        headers["date"],
+    )
+
+    for candidate in candidates:
+        if not candidate:
+            continue
+        # A field holding garbage (e.g. an out of range year) must not prevent trying the next ones
+        try:
+            parsed = email.utils.parsedate_tz(str(candidate))
+            if parsed is None:
+                continue
+            delivery_time = email.utils.mktime_tz(parsed)
+        except (OverflowError, ValueError, TypeError):
             continue
+        # Some servers ignore, and some clients set, dates before epoch
+        if delivery_time >= 0:
+            return delivery_time
+
+    return None
 
-        user_backup_dir = os.path.join(backup_dir, migration.old.username.replace("@", "_at_"))
+
+def _parse_mbox(path: str) -> List[Tuple[int, int, Optional[float]]]:
+    """
+    Find messages of a mbox file, and their delivery times.
+
+    This is CPU bound and runs in worker processes, so that parsing the next mboxes is overlapped with uploading the
+    current one. Only header fields are parsed, and only offsets and delivery times are sent back: the uploading
+    thread reads each message at its offsets, so that it doesn't scan the mbox file again and memory usage does not
+    depend on mbox sizes.
+
+    Messages are split as mailbox.mbox does, on lines starting with "From ", the blank line preceding them being part
+    of the mbox format rather than of the message.
+
+    :param path: Path to the mbox file.
+    :type path: str
+    :return: (start, stop, delivery time) tuples, start and stop delimiting the raw message, From_ line excluded.
+    :rtype: List[Tuple[int, int, Optional[float]]]
+    """
+    parser = email.parser.BytesHeaderParser()
+    toc = []
+    from_line = None  # type: Optional[str]
+    start = 0
+    header_lines = []  # type: List[bytes]
+    in_header = False
+
+    def _add_message(stop: int):
+        headers = parser.parsebytes(b"".join(header_lines))
+        toc.append((start, stop, _get_delivery_time(from_line, headers)))
+
+    with open(path, "rb") as mbox_file:
+        position = 0
+        empty_line_length = 0
+        for line in mbox_file:
+            if line.startswith(b"From "):
+                if from_line is not None:
+                    _add_message(position - empty_line_length)
+                from_line = line[5:].rstrip(b"\r\n").decode("ascii", errors="replace")
+                start = position + len(line)
+                header_lines = []
+                in_header = True
+                empty_line_length = 0
+            else:
+                empty_line_length = len(line) if line in (b"\n", b"\r\n") else 0
+                # Header ends at the first empty line
+                if in_header and empty_line_length:
+                    in_header = False
+                elif in_header:
+                    header_lines.append(line)
+
+            position += len(line)
+
+        if from_line is not None:
+            _add_message(position - empty_line_length)
+
+    return toc
+
+
+def _iter_mbox_messages(path: str,
+                        toc: List[Tuple[int, int, Optional[float]]]) -> Iterator[Tuple[Optional[float], bytes]]:
+    """
+    Read raw messages of a mbox file, one at a time.
+
+    :param path: Path to the mbox file.
+    :type path: str
+    :param toc: Offsets and delivery times of the messages, as returned by _parse_mbox.
+    :type toc: List[Tuple[int, int, Optional[float]]]
+    :return: Iterator over (delivery time, raw message) tuples.
+    :rtype: Iterator[Tuple[Optional[float], bytes]]
+    """
+    with open(path, "rb") as mbox_file:
+        for start, stop, delivery_time in toc:
+            mbox_file.seek(start)
+            message = mbox_file.read(stop - start)
+            if len(message) != stop - start:
+                raise mailboxlib.Error(f"{path} changed while being restored")
+            yield delivery_time, message
+
+
+def _iter_mbox_files(root: str) -> Iterator[str]:
+    """
+    Recursively find mbox files in a directory.
+
+    :param root: Directory to search.
+    :type root: str
+    :return: Iterator over paths of mbox files, starting with root.
+    :rtype: Iterator[str]
+    """
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _iter_mbox_files(entry.path)
+            elif entry.name.endswith(".mbox") and entry.is_file():
+                yield entry.path
+
+
+def _append_messages(backend: ImapBackend, messages: Iterable[Tuple[Optional[float], bytes]],
+                     box_imap_path: str) -> int:
+    failed_count = 0
+
+    for delivery_time, message in messages:
+        try:
+            result = backend.append(box_imap_path, delivery_time, message)
+        except imaplib.IMAP4.abort:
+            # Connection is dead even after retries, the other messages would fail the same way
+            raise
+        except imaplib.IMAP4.error as e:
+            result = str(e)
+
+        if result != "OK":
+            logger.error("Could not append message to folder %s of mailbox %s: %s", box_imap_path,
+                         backend.mailbox.username, result)
+            failed_count += 1
+
+    return failed_count
+
+
+def _iter_batches(messages: Iterable[Tuple[Optional[float], bytes]], max_count: int,
+                  max_bytes: int) -> Iterator[List[Tuple[Optional[float], bytes]]]:
+    """
+    Group messages in batches of at most `max_count` messages and `max_bytes` bytes.
+
+    :param messages: (delivery time, raw message) tuples.
+    :type messages: Iterable[Tuple[Optional[float], bytes]]
+    :param max_count: Maximum number of messages per batch.
+    :type max_count: int
+    :param max_bytes: Maximum size of messages per batch, a larger message makes a batch on its own.
+    :type max_bytes: int
+    :return: Iterator over batches.
+    :rtype: Iterator[List[Tuple[Optional[float], bytes]]]
+    """
+    batch = []
+    batch_bytes = 0
+    for delivery_time, message in messages:
+        if batch and (len(batch) >= max_count or batch_bytes + len(message) > max_bytes):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append((delivery_time, message))
+        batch_bytes += len(message)
+
+    if batch:
+        yield batch
+
+
+def _restore_folder(backend: ImapBackend, box_file_path: str, toc: List[Tuple[int, int, Optional[float]]],
+                    box_imap_path: str) -> bool:
+    logger.info("Restoring folder %s of mailbox %s", box_imap_path, backend.mailbox.username)
+
+    failed_count = 0
+    backend.create(box_imap_path)
+    messages = _iter_mbox_messages(box_file_path, toc)
+
+    if not backend.supports_multiappend:
+        failed_count += _append_messages(backend, messages, box_imap_path)
+    else:
+        for batch in _iter_batches(messages, MULTIAPPEND_BATCH_SIZE, MULTIAPPEND_BATCH_BYTES):
+            try:
+                result = backend.multiappend(box_imap_path, batch)
+            except imaplib.IMAP4.abort:
+                # Connection is dead even after retries, appending one by one would only retry again
+                raise
+            except imaplib.IMAP4.error as e:
+                result = str(e)
+
+            if result != "OK":
+                # Server answered NO or BAD, nothing was appended: find out which messages are refused
+                logger.warning("MULTIAPPEND to folder %s of mailbox %s failed (%s), appending messages one by one.",
+                               box_imap_path, backend.mailbox.username, result)
+                failed_count += _append_messages(backend, batch, box_imap_path)
+
+    logger.debug("Restored folder %s of mailbox %s (OK: %d, failed: %d)", box_imap_path, backend.mailbox.username,
+                 len(toc) - failed_count, failed_count)
+
+    return failed_count == 0
+
+
+def restore_mailboxes(migrations: Iterable[Migration], backup_dir: str, jobs: int,
+                      per_user_jobs: int) -> List[Migration]:
+    success = []
+    failures = []
+    # Only a few mboxes per session are parsed ahead of the upload
+    parse_ahead = os.cpu_count() or 1
+
+    def _restore_session(migration: Migration, next_box_file: Callable[[], Optional[Tuple[str, Future]]],
+                         user_backup_dir: str) -> Optional[str]:
+        # A session uploads several mboxes of a user, to only pay for connection and login once
+        failure = None
+        with ImapBackend(migration.new) as backend:
+            for box_file_path, parsed in iter(next_box_file, None):
+                box_imap_path = os.path.relpath(box_file_path, user_backup_dir)[:-5]
+                if not _restore_folder(backend, box_file_path, parsed.result(), box_imap_path):
+                    failure = "some messages could not be restored"
+
+        return failure
+
+    def _restore_one(migration: Migration) -> Optional[str]:
+        user_backup_dir = os.path.join(backup_dir, migration.old.safe_username)
         if not os.path.exists(user_backup_dir):
-            logger.error("Could not find backup directory {}, skipping this mailbox.".format(user_backup_dir))
-            continue
+            logger.error("Could not find backup directory %s, skipping this mailbox.", user_backup_dir)
+            return f"backup directory {user_backup_dir} not found"
+
+        logger.info("Restoring old %s to new %s", migration.old.username, migration.new.username)
+
+        # Restore all mboxes to their original path (ie., sub-directories in mailboxes). Largest ones go first, so
+        # that a large mbox doesn't end up uploaded alone while the other sessions are done.
+        box_files = sorted(_iter_mbox_files(user_backup_dir), key=os.path.getsize, reverse=True)
+
+        # Only a few sessions per user run at once, to stay below the destination server's per-account connection
+        # limit. Errors of a session are raised by result() and fail the whole migration.
+        sessions_count = min(per_user_jobs, len(box_files))
+        if sessions_count == 0:
+            return None
+
+        # Sessions pull mboxes from a shared queue as they get done with the previous one, keeping the next mboxes
+        # being parsed
+        box_files_iter = iter(box_files)
+        parsing = deque((box_file_path, parse_executor.submit(_parse_mbox, box_file_path))
+                        for box_file_path in islice(box_files_iter, parse_ahead * sessions_count))
+        parsing_lock = threading.Lock()
+
+        def _next_box_file() -> Optional[Tuple[str, Future]]:
+            with parsing_lock:
+                if not parsing:
+                    return None
+                next_box_file_path = next(box_files_iter, None)
+                if next_box_file_path is not None:
+                    parsing.append((next_box_file_path, parse_executor.submit(_parse_mbox, next_box_file_path)))
+                return parsing.popleft()
 
-        logger.info("Restoring old {old} to new {new}".format(old=migration.old.username, new=migration.new.username))
-
-        return_codes_all_ok = True
-        for root, dirs, files in os.walk(user_backup_dir):
-            for filename in files:
-                # Restore all mboxes to their original path (ie., sub-directories in mailboxes)
-                if filename.endswith(".mbox"):
-                    box_file_relpath = os.path.join(root, filename)
-                    box_file_abspath = os.path.abspath(box_file_relpath)
-                    box_imap_path = os.path.relpath(box_file_relpath, user_backup_dir)[:-5]
-                    use_ssl = "--ssl" if migration.new.use_ssl else ""
-
-                    cmdl = shlex.split('imap_upload/imap_upload.py --retry 3 {ssl} --host "{host}" --port {port} '
-                                       '--user "{username}" --password "{password}" --box "{box_path}" '
-                                       '"{mbox_file}"'.format(ssl=use_ssl, host=migration.new.host,
-                                                              port=migration.new.port, username=migration.new.username,
-                                                              password=migration.new.password, box_path=box_imap_path,
-                                                              mbox_file=box_file_abspath))
-                    cmdl_without_password = cmdl.copy()
-                    cmdl_without_password[-4] = "******"
-                    logger.debug(cmdl_without_password)
-
-                    return_code = subprocess.call(cmdl)
-                    print(return_code)
-
-                    if return_code != 0:
-                        return_codes_all_ok = False
-
-        if return_codes_all_ok:
-            success.append(migration)
+        try:
+            with ThreadPoolExecutor(max_workers=sessions_count) as user_executor:
+                sessions = [user_executor.submit(_restore_session, migration, _next_box_file, user_backup_dir)
+                            for _ in range(sessions_count)]
+                session_failures = [session.result() for session in sessions]
+        finally:
+            # Left over when all sessions failed
+            with parsing_lock:
+                for _, parsed in parsing:
+                    parsed.cancel()
+
+        return next((failure for failure in session_failures if failure is not None), None)
+
+    def _run_one(migration: Migration) -> Tuple[Migration, Optional[str]]:
+        # A failing migration must not take the others down, as when each mbox had its own imap_upload process
+        try:
+            return migration, _restore_one(migration)
+        except (imaplib.IMAP4.error, mailboxlib.Error, OSError) as e:
+            logger.error("Restoring to %s failed: %s", migration.new, e)
+            return migration, str(e)
+        except Exception as e:
+            logger.exception("Restoring to %s failed unexpectedly", migration.new)
+            return migration, f"{type(e).__name__}: {e}"
+
+    def _restorable(migration: Migration) -> bool:
+        if not migration.new.is_complete():
+            logger.warning("Skipping incomplete mailbox %s", migration.new)
+            return False
+        # The backup to restore is looked up by the "old" username only
+        if not migration.old.username:
+            logger.warning("Skipping mailbox %s without an \"old\" username to find its backup", migration.new)
+            return False
+        return True
+
+    # Workers are spawned rather than forked, as forking while migration and logging threads run is unsafe
+    with ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn")) as parse_executor, \
+            ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(_run_one, migration) for migration in migrations if _restorable(migration)]
+        for future in as_completed(futures):
+            migration, failure = future.result()
+
+            if failure is None:
+                success.append(migration)
+            else:
+                failures.append((migration, failure))
+
+    _report_failures("Restore failed", failures)
 
     return success
 
@@ -276,23 +1054,34 @@ def main() -> int:
     init_logger(args.verbosity)
 
     migrations = parse_mailboxes_csv(args.csv, args.mailboxes)
-    logger.info("Operating on following mailboxes:\n{}".format(pformat(migrations)))
+
+    # CSV is streamed to a single action, but the iterator must be materialized when migrations are needed several
+    # times, otherwise the next consumer would find it exhausted
+    actions_count = sum((args.listold, args.listnew, args.backup, args.restore))
+    if actions_count > 1 or logger.isEnabledFor(logging.INFO):
+        migrations = list(migrations)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Operating on following mailboxes:\n%s", pformat(migrations))
 
     if args.listold:
-        success = list_mailboxes(migrations, "old")
-        logger.debug("Listing succeeded for following mailboxes:\n{}".format(pformat(success)))
+        success = list_mailboxes(migrations, attrgetter("old"), args.jobs)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Listing succeeded for following mailboxes:\n%s", pformat(success))
 
     if args.listnew:
-        success = list_mailboxes(migrations, "new")
-        logger.debug("Listing succeeded for following mailboxes:\n{}".format(pformat(success)))
+        success = list_mailboxes(migrations, attrgetter("new"), args.jobs)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Listing succeeded for following mailboxes:\n%s", pformat(success))
 
     if args.backup:
-        success = backup_mailboxes(migrations, args.output)
-        logger.debug("Successfully backed up following mailboxes:\n{}".format(pformat(success)))
+        success = backup_mailboxes(migrations, args.output, args.jobs)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Successfully backed up following mailboxes:\n%s", pformat(success))
 
     if args.restore:
-        success = restore_mailboxes(migrations, args.output)
-        logger.debug("Successfully ran following mailbox migrations:\n{}".format(pformat(success)))
+        success = restore_mailboxes(migrations, args.output, args.jobs, args.per_user_jobs)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Successfully ran following mailbox migrations:\n%s", pformat(success))
 
     return 0
 
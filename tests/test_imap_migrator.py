@@ -0,0 +1,167 @@
+import mailbox
+import os
+import re
+import socketserver
+import tempfile
+import threading
+import unittest
+
+import imap_migrator
+
+
+class FakeImapHandler(socketserver.StreamRequestHandler):
+    """
+    Minimal IMAP server, answering just what ImapBackend needs to log in and append messages.
+    """
+
+    _literal_re = re.compile(rb'(?:"(?P<date>\d\d-\w{3}-\d{4} [^"]*)" )?\{(?P<size>\d+)(?P<plus>\+?)\}$')
+
+    def write(self, data: bytes):
+        self.wfile.write(data)
+        self.wfile.flush()
+
+    def handle(self):
+        self.write(b"* OK ready\r\n")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            tag, command, *_ = line.rstrip(b"\r\n").split(b" ", 2)
+            command = command.upper()
+
+            if command == b"CAPABILITY":
+                self.write(b"* CAPABILITY IMAP4rev1 " + self.server.capabilities + b"\r\n" + tag + b" OK done\r\n")
+            elif command == b"LOGIN":
+                self.write(tag + b" OK logged in\r\n")
+            elif command == b"APPEND":
+                self.handle_append(tag, line)
+            elif command == b"LOGOUT":
+                self.write(b"* BYE\r\n" + tag + b" OK done\r\n")
+                return
+            else:
+                self.write(tag + b" BAD unknown command\r\n")
+
+    def handle_append(self, tag: bytes, line: bytes):
+        messages = []
+        while True:
+            match = self._literal_re.search(line.rstrip(b"\r\n"))
+            if match is None:
+                break
+            if not match.group("plus"):
+                self.server.continuations += 1
+                self.write(b"+ ready\r\n")
+            messages.append((match.group("date"), self.rfile.read(int(match.group("size")))))
+            # Rest of the command line, announcing the next message, if any
+            line = self.rfile.readline()
+
+        self.server.appends.append(messages)
+        self.write(tag + b" " + self.server.append_response + b" done\r\n")
+
+
+class FakeImapServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+    def __init__(self, capabilities: bytes, append_response: bytes = b"OK"):
+        super().__init__(("127.0.0.1", 0), FakeImapHandler)
+        self.capabilities = capabilities
+        self.append_response = append_response
+        self.appends = []
+        self.continuations = 0
+
+
+class MultiappendTest(unittest.TestCase):
+    messages = [
+        (1514764800, b"Subject: first\n\nbody\n"),
+        (None, b"Subject: second\r\n\r\nbody\r\n"),
+        (1514851200, b"Subject: third\n\n" + b"x" * 5000 + b"\n"),
+    ]
+
+    def multiappend(self, capabilities: bytes, append_response: bytes = b"OK") -> str:
+        self.server = FakeImapServer(capabilities, append_response)
+        self.addCleanup(self.server.server_close)
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.shutdown)
+
+        mailbox = imap_migrator.Mailbox("new", "user", "password", "127.0.0.1", self.server.server_address[1], False)
+        with imap_migrator.ImapBackend(mailbox, timeout=5) as backend:
+            return backend.multiappend("INBOX", self.messages)
+
+    def assert_appended_once(self):
+        self.assertEqual(len(self.server.appends), 1)
+        appended = self.server.appends[0]
+        self.assertEqual([date for date, _ in appended],
+                         [b"01-Jan-2018 00:00:00 +0000", None, b"02-Jan-2018 00:00:00 +0000"])
+        self.assertEqual([message for _, message in appended],
+                         [b"Subject: first\r\n\r\nbody\r\n", b"Subject: second\r\n\r\nbody\r\n",
+                          b"Subject: third\r\n\r\n" + b"x" * 5000 + b"\r\n"])
+
+    def test_synchronizing_literals(self):
+        self.assertEqual(self.multiappend(b"MULTIAPPEND"), "OK")
+        self.assert_appended_once()
+        self.assertEqual(self.server.continuations, 3)
+
+    def test_literal_plus(self):
+        self.assertEqual(self.multiappend(b"MULTIAPPEND LITERAL+"), "OK")
+        self.assert_appended_once()
+        self.assertEqual(self.server.continuations, 0)
+
+    def test_literal_minus(self):
+        # Only the message larger than 4096 bytes waits for a continuation request
+        self.assertEqual(self.multiappend(b"MULTIAPPEND LITERAL-"), "OK")
+        self.assert_appended_once()
+        self.assertEqual(self.server.continuations, 1)
+
+    def test_refused(self):
+        self.assertEqual(self.multiappend(b"MULTIAPPEND LITERAL+", b"NO"), "NO")
+
+
+class IterBatchesTest(unittest.TestCase):
+    def test_count_and_bytes_limits(self):
+        messages = [(None, b"x" * size) for size in (3, 3, 3, 10, 1, 1, 1)]
+        batches = imap_migrator._iter_batches(messages, 3, 8)
+        self.assertEqual([[len(message) for _, message in batch] for batch in batches], [[3, 3], [3], [10], [1, 1, 1]])
+
+
+class ParseMboxTest(unittest.TestCase):
+    mbox = (b"From a@example.com Mon Jan  1 10:00:00 2018\n"
+            b"Date: Tue, 02 Jan 2018 10:00:00 +0100\n"
+            b"Subject: first\n"
+            b"\n"
+            b"body\n"
+            b">From quoted\n"
+            b"\n"
+            b"From b@example.com\n"
+            b"Received: from mx; Wed, 03 Jan 2018 10:00:00 +0000\n"
+            b"Date: Thu, 01 Jan 99999999999 00:00:00 +0000\n"
+            b"\n"
+            b"no separator line\n"
+            b"From c@example.com\n"
+            b"Date: Thu, 01 Jan 99999999999 00:00:00 +0000\n"
+            b"\n"
+            b"\n"
+            b"From d@example.com Mon, Jan  1 2018\n"
+            b"Subject: empty body\n")
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".mbox")
+        self.addCleanup(os.remove, self.path)
+        with os.fdopen(fd, "wb") as mbox_file:
+            mbox_file.write(self.mbox)
+
+    def test_same_messages_as_mailbox(self):
+        toc = imap_migrator._parse_mbox(self.path)
+        messages = list(imap_migrator._iter_mbox_messages(self.path, toc))
+
+        mbox = mailbox.mbox(self.path, create=False)
+        self.addCleanup(mbox.close)
+        self.assertEqual([message for _, message in messages], [mbox.get_bytes(key) for key in mbox.keys()])
+
+    def test_delivery_times(self):
+        toc = imap_migrator._parse_mbox(self.path)
+        # From_ line first, then "Received:", out of range dates are skipped, From_ lines may only hold a date
+        self.assertEqual([delivery_time for _, _, delivery_time in toc], [1514800800, 1514973600, None, 1514764800])
+
+
+if __name__ == "__main__":
+    unittest.main()